@@ -2,7 +2,7 @@
 main.py (FastAPI) - completo y corregido para tu Predictor
 
 Tu Predictor tiene firma:
-Predictor(project_root: Path)
+Predictor(project_root: Path, load_on_init: bool = True)
 
 Incluye:
 - /health
@@ -17,20 +17,24 @@ Incluye:
 Notas:
 - PROJECT_ROOT se calcula desde app/backend/main.py subiendo 2 niveles a IA-final.
 - ts es anti-cache (se ignora en backend).
+- /predict* aceptan deadline_ms; con sobrecarga responden 503 (shed) o 504 (deadline vencido).
 """
 
 from __future__ import annotations
 
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional
 
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from matplotlib.units import registry
 
+from services.admission import AdmissionController, DeadlineExceeded, check_deadline
 from services.predictor import Predictor
 from services.retrain_runner import run_incremental_retrain
 
@@ -89,8 +93,44 @@ app.add_middleware(
 # Predictor (TU FIRMA)
 # --------------------------------------------------------------------------------------
 
-# Tu Predictor requiere project_root
-predictor = Predictor(project_root=PROJECT_ROOT)
+# Tu Predictor requiere project_root.
+# La carga + warm-up corre en segundo plano: /health responde ready=False hasta que termina.
+predictor = Predictor(project_root=PROJECT_ROOT, load_on_init=False)
+
+
+# Cargas en segundo plano (inicial / auto-reload del registry): una a la vez.
+# Si ya hay una en curso, /health no lanza otra (evita cargar + calentar dos veces).
+_model_load_lock = threading.Lock()
+LAST_LOAD_ERROR: Optional[str] = None
+
+
+def _initial_load() -> None:
+    global LAST_LOAD_ERROR
+    try:
+        predictor.reload()
+        LAST_LOAD_ERROR = None
+        admission.seed(predictor.warmup_image_ms)
+        write_app_log(f"Model ready (warm-up {predictor.warmup_ms:.0f} ms)")
+    except Exception as e:
+        LAST_LOAD_ERROR = f"Initial model load failed: {e}"
+        write_app_log(LAST_LOAD_ERROR)
+    finally:
+        _model_load_lock.release()
+
+
+@app.on_event("startup")
+def _start_initial_load() -> None:
+    _model_load_lock.acquire()
+    threading.Thread(target=_initial_load, daemon=True).start()
+
+
+# Control de admisión / deadlines para /predict*
+admission = AdmissionController()
+
+
+def _require_ready() -> None:
+    if not predictor.ready:
+        raise HTTPException(status_code=503, detail="Modelo cargando / warm-up en curso")
 
 # --------------------------------------------------------------------------------------
 # Endpoints
@@ -165,22 +205,39 @@ def _get_registry_info():
 
 CURRENT_PROD_VERSION = None
 
+
+def _registry_reload(prod_version: int) -> None:
+    global CURRENT_PROD_VERSION, LAST_LOAD_ERROR
+    try:
+        prev_ckpt = predictor.ckpt_path
+        loaded = predictor.reload_from_registry(REGISTERED_MODEL_NAME, stage="Production")
+        if loaded:
+            write_app_log(
+                f"Auto-reload OK -> Production v{prod_version} (warm-up {predictor.warmup_ms:.0f} ms)"
+            )
+            CURRENT_PROD_VERSION = prod_version
+            LAST_LOAD_ERROR = None
+            if predictor.ckpt_path != prev_ckpt:
+                # modelo nuevo: re-sembrar la EWMA con su tiempo en régimen
+                admission.seed(predictor.warmup_image_ms)
+    except Exception as e:
+        LAST_LOAD_ERROR = f"Auto-reload from registry failed: {e}"
+        write_app_log(LAST_LOAD_ERROR)
+    finally:
+        _model_load_lock.release()
+
+
 @app.get("/health")
 def health():
-    global CURRENT_PROD_VERSION
-
     registry = _get_registry_info()
     prod_version = registry.get("production_version")
 
-    # 🔥 intentar recargar desde MLflow Registry siempre que haya Production
+    # 🔥 intentar recargar desde MLflow Registry siempre que haya Production.
+    # Corre en segundo plano; si ya hay una carga en curso (inicial o reload), se salta.
+    # Si la carga local falló, esto también sirve de fallback.
     if prod_version is not None and prod_version != CURRENT_PROD_VERSION:
-        try:
-            loaded = predictor.reload_from_registry(REGISTERED_MODEL_NAME, stage="Production")
-            if loaded:
-                write_app_log(f"Auto-reload OK -> Production v{prod_version}")
-                CURRENT_PROD_VERSION = prod_version
-        except Exception as e:
-            write_app_log(f"Auto-reload from registry failed: {e}")
+        if _model_load_lock.acquire(blocking=False):
+            threading.Thread(target=_registry_reload, args=(prod_version,), daemon=True).start()
 
     # info del predictor
     active = {}
@@ -191,7 +248,13 @@ def health():
             active = {"error": str(e)}
 
     return {
-        "ok": True,
+        "ok": predictor.ready or LAST_LOAD_ERROR is None,
+        "ready": predictor.ready,
+        "loading": _model_load_lock.locked(),
+        "load_error": LAST_LOAD_ERROR,
+        "warming_up": predictor.warming_up,
+        "warmup_ms": predictor.warmup_ms,
+        "admission": admission.snapshot(),
         "active_model": active,
         **registry,
         "project_root": str(PROJECT_ROOT),
@@ -200,22 +263,61 @@ def health():
 
 
 
+def _shed(deadline: float, n_images: int, endpoint: str) -> None:
+    """Rechaza (503) si la espera estimada en cola no alcanza para el deadline."""
+    if not admission.try_admit(n_images, deadline):
+        wait_ms = admission.estimated_wait_ms()
+        write_app_log(f"{endpoint} shed n={n_images} est_wait_ms={wait_ms:.0f}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Sobrecarga: espera estimada {wait_ms:.0f} ms supera el deadline",
+            headers={"Retry-After": str(max(1, int(wait_ms / 1000.0)))},
+        )
+
+
 @app.post("/predict")
 async def predict(
     image: UploadFile = File(...),
-    score_threshold: float = Form(0.5),
+    score_threshold: float = Form(0.5, ge=0.0, le=1.0),
+    max_detections: Optional[int] = Form(None, ge=1),
+    nms_iou: Optional[float] = Form(None, ge=0.0, le=1.0),
+    deadline_ms: Optional[float] = Form(None),
 ):
     """
     Predice objetos en 1 imagen.
+    max_detections / nms_iou se aplican dentro de roi_heads (None = defaults del modelo).
+    deadline_ms: presupuesto del cliente (None = REQUEST_DEADLINE_MS).
     """
+    _require_ready()
     t0 = time.perf_counter()
-    content = await image.read()
+    deadline = admission.deadline_for(deadline_ms)
+    _shed(deadline, 1, "/predict")
+
+    try:
+        content = await image.read()
 
-    write_app_log(f"/predict file={image.filename}")
+        write_app_log(f"/predict file={image.filename}")
 
-    result = predictor.predict_bytes(
-        content, score_threshold=score_threshold
-    )
+        result = await run_in_threadpool(
+            predictor.predict_bytes,
+            content,
+            score_threshold=score_threshold,
+            max_detections=max_detections,
+            nms_iou=nms_iou,
+            deadline=deadline,
+        )
+    except DeadlineExceeded as e:
+        admission.record_shed(e.stage)
+        write_app_log(f"/predict deadline exceeded before {e.stage}")
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception:
+        admission.fail()
+        raise
+    finally:
+        admission.release(1)
+
+    admission.finish()
+    admission.observe(result["inference_ms"])
     result["filename"] = image.filename
     result["request_ms"] = (time.perf_counter() - t0) * 1000.0
 
@@ -225,21 +327,58 @@ async def predict(
 @app.post("/predict-multi")
 async def predict_multi(
     images: List[UploadFile] = File(...),
-    score_threshold: float = Form(0.5),
+    score_threshold: float = Form(0.5, ge=0.0, le=1.0),
+    max_detections: Optional[int] = Form(None, ge=1),
+    nms_iou: Optional[float] = Form(None, ge=0.0, le=1.0),
+    deadline_ms: Optional[float] = Form(None),
 ):
     """
     Predice objetos en múltiples imágenes.
+    Si el deadline vence a mitad del lote, las imágenes restantes vuelven con ok=False.
     """
+    _require_ready()
+    deadline = admission.deadline_for(deadline_ms)
+    _shed(deadline, len(images), "/predict-multi")
     write_app_log(f"/predict-multi n={len(images)}")
 
     results = []
-    for img in images:
-        content = await img.read()
-        r = predictor.predict_bytes(
-            content, score_threshold=score_threshold
-        )
-        r["filename"] = img.filename
-        results.append(r)
+    shed = False
+    pending = len(images)  # slots aún reservados en la cola de admisión
+    try:
+        for i, img in enumerate(images):
+            try:
+                check_deadline(deadline, "decode")
+                content = await img.read()
+                r = await run_in_threadpool(
+                    predictor.predict_bytes,
+                    content,
+                    score_threshold=score_threshold,
+                    max_detections=max_detections,
+                    nms_iou=nms_iou,
+                    deadline=deadline,
+                )
+                admission.observe(r["inference_ms"])
+            except DeadlineExceeded as e:
+                # vencido: esta imagen y las que faltan se descartan sin trabajo
+                skipped = images[i:]
+                admission.record_shed(e.stage, n_images=len(skipped))
+                for rest in skipped:
+                    results.append({"ok": False, "error": str(e), "filename": rest.filename})
+                shed = True
+                break
+            finally:
+                admission.release(1)
+                pending -= 1
+            r["filename"] = img.filename
+            results.append(r)
+    except Exception:
+        admission.fail()
+        raise
+    finally:
+        admission.release(pending)
+
+    if not shed:
+        admission.finish()
 
     return {"ok": True, "results": results}
 
@@ -0,0 +1,136 @@
+"""
+admission.py
+- Control de admisión para /predict y /predict-multi.
+- Estima la espera en cola como (imágenes en vuelo) * EWMA del tiempo por imagen.
+- Si la espera en cola supera el deadline del request, se rechaza antes de hacer trabajo.
+  Con la cola vacía siempre se admite; el propio lote se corta con los checks de deadline.
+- Lleva contadores de requests admitidos / terminados / descartados (shed) por etapa,
+  más imágenes descartadas. admitted == completed + failed + shed[decode|forward] + en vuelo.
+- La EWMA arranca de ADMISSION_INITIAL_IMAGE_MS y se re-siembra con el warm-up de cada modelo.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+DEFAULT_DEADLINE_MS = float(os.environ.get("REQUEST_DEADLINE_MS", "10000"))
+EWMA_ALPHA = 0.2
+_initial = os.environ.get("ADMISSION_INITIAL_IMAGE_MS")
+INITIAL_IMAGE_MS: Optional[float] = float(_initial) if _initial else None
+
+
+class DeadlineExceeded(Exception):
+    """El deadline del request venció antes de `stage` (decode | forward)."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"deadline vencido antes de {stage}")
+        self.stage = stage
+
+
+def check_deadline(deadline: Optional[float], stage: str) -> None:
+    """deadline es absoluto en reloj time.perf_counter()."""
+    if deadline is not None and time.perf_counter() >= deadline:
+        raise DeadlineExceeded(stage)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        default_deadline_ms: float = DEFAULT_DEADLINE_MS,
+        alpha: float = EWMA_ALPHA,
+        initial_image_ms: Optional[float] = INITIAL_IMAGE_MS,
+    ):
+        self.default_deadline_ms = default_deadline_ms
+        self.alpha = alpha
+
+        self._lock = threading.Lock()
+        self._inflight = 0  # imágenes admitidas y aún no terminadas
+        self._ewma_ms: Optional[float] = initial_image_ms
+
+        # contadores por request; shed_images cuenta imágenes descartadas
+        self.admitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.shed = {"admission": 0, "decode": 0, "forward": 0}
+        self.shed_images = 0
+
+    def deadline_for(self, deadline_ms: Optional[float]) -> float:
+        ms = deadline_ms if deadline_ms and deadline_ms > 0 else self.default_deadline_ms
+        return time.perf_counter() + ms / 1000.0
+
+    def _queue_wait_ms(self) -> float:
+        if self._ewma_ms is None:
+            return 0.0
+        return self._inflight * self._ewma_ms
+
+    def estimated_wait_ms(self) -> float:
+        """Espera estimada en cola (sin contar el servicio del propio request)."""
+        with self._lock:
+            return self._queue_wait_ms()
+
+    def try_admit(self, n_images: int, deadline: float) -> bool:
+        """
+        Reserva n_images en la cola si la espera estimada antes de empezar cabe en el deadline.
+        Con la cola vacía siempre admite.
+        """
+        with self._lock:
+            wait_ms = self._queue_wait_ms()
+            if self._inflight > 0 and time.perf_counter() + wait_ms / 1000.0 > deadline:
+                self.shed["admission"] += 1
+                self.shed_images += n_images
+                return False
+            self._inflight += n_images
+            self.admitted += 1
+            return True
+
+    def release(self, n_images: int = 1) -> None:
+        """Libera imágenes de la cola (terminadas o descartadas)."""
+        with self._lock:
+            self._inflight = max(0, self._inflight - n_images)
+
+    def finish(self) -> None:
+        """Cuenta un request admitido que terminó sin ser descartado."""
+        with self._lock:
+            self.completed += 1
+
+    def fail(self) -> None:
+        """Cuenta un request admitido que terminó con error (no por deadline)."""
+        with self._lock:
+            self.failed += 1
+
+    def seed(self, image_ms: Optional[float]) -> None:
+        """
+        Reinicia la EWMA con el tiempo por imagen del modelo recién activado
+        (último pase del warm-up); se llama en cada cambio de modelo.
+        """
+        with self._lock:
+            if image_ms is not None and image_ms > 0:
+                self._ewma_ms = image_ms
+
+    def observe(self, service_ms: float) -> None:
+        """Actualiza la EWMA del tiempo de servicio por imagen (decode + forward)."""
+        with self._lock:
+            if self._ewma_ms is None:
+                self._ewma_ms = service_ms
+            else:
+                self._ewma_ms = self.alpha * service_ms + (1 - self.alpha) * self._ewma_ms
+
+    def record_shed(self, stage: str, n_images: int = 1) -> None:
+        """Un request descartado en `stage`, con n_images imágenes sin procesar."""
+        with self._lock:
+            self.shed[stage] = self.shed.get(stage, 0) + 1
+            self.shed_images += n_images
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "inflight_images": self._inflight,
+                "ewma_image_ms": round(self._ewma_ms, 1) if self._ewma_ms is not None else None,
+                "default_deadline_ms": self.default_deadline_ms,
+                "admitted": self.admitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "shed": dict(self.shed),
+                "shed_images": self.shed_images,
+            }
@@ -0,0 +1,320 @@
+"""
+ckpt_cache.py
+- Cache local de checkpoints (.pt) descargados desde MLflow Model Registry.
+- Los archivos se guardan por contenido (sha256) en models/local_checkpoints/cache/blobs.
+- El índice (index.json) mapea run_id + artifact -> digest, para no volver a descargar.
+- Usa reflink / hardlink en vez de copiar bytes cuando la fuente es file:.
+  Un hardlink comparte inode con la fuente: si size/mtime cambian, el blob se invalida.
+- Evicción LRU con tope de tamaño (CKPT_CACHE_MAX_MB). Solo cuentan los blobs que son
+  dueños de sus bytes (st_nlink == 1); los hardlinks vivos se limitan por cantidad.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_MAX_MB = int(os.environ.get("CKPT_CACHE_MAX_MB", "2048"))
+
+# ioctl FICLONE (Linux: btrfs / xfs). Si no aplica, caemos a copia normal.
+_FICLONE = 0x40049409
+
+# un path devuelto por get_* queda protegido de la evicción este tiempo,
+# para que un prefetch concurrente no lo borre antes de cargarlo / pinnearlo
+LEASE_S = 600.0
+
+# máximo de entradas hardlink (con la fuente aún viva) que se mantienen en el índice
+MAX_LINKED_ENTRIES = 32
+
+
+def _sha256_file(path: Path, chunk: int = 8 * 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _link_or_copy(src: Path, dst: Path) -> str:
+    """
+    Intenta reflink -> hardlink -> copia. Devuelve el método usado.
+    El reflink va primero: es copy-on-write, así que reescribir la fuente no toca el blob.
+    """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fs, open(dst, "wb") as fd:
+                fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+            return "reflink"
+        except OSError:
+            dst.unlink(missing_ok=True)
+
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class CheckpointCache:
+    def __init__(self, cache_dir: Path, max_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir.resolve()
+        self.blobs_dir = self.cache_dir / "blobs"
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes if max_bytes is not None else DEFAULT_MAX_MB * 1024 * 1024
+
+        self._lock = threading.RLock()
+        self._pinned: Optional[str] = None
+        self._leases: Dict[str, float] = {}  # path -> instante en que se entregó
+        self.last_prefetch: Optional[Dict] = None
+        self._index = self._read_index()
+
+    # -------------------------
+    # Index
+    # -------------------------
+    def _read_index(self) -> Dict:
+        if self.index_path.exists():
+            try:
+                data = json.loads(self.index_path.read_text(encoding="utf-8"))
+                data.setdefault("keys", {})
+                data.setdefault("blobs", {})
+                return data
+            except (OSError, ValueError):
+                pass
+        return {"keys": {}, "blobs": {}}
+
+    def _write_index(self) -> None:
+        tmp = self.index_path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(self._index, indent=2), encoding="utf-8")
+        os.replace(tmp, self.index_path)
+
+    def _blob_path(self, digest: str, name: str) -> Path:
+        suffix = Path(name).suffix or ".pt"
+        return self.blobs_dir / f"{digest}{suffix}"
+
+    def _lookup(self, key: str) -> Optional[Path]:
+        digest = self._index["keys"].get(key)
+        if digest is None:
+            return None
+        blob = self._index["blobs"].get(digest)
+        if blob is None:
+            self._index["keys"].pop(key, None)
+            return None
+        if not self._blob_valid(blob):
+            self._drop(digest)
+            return None
+        blob["last_used"] = time.time()
+        return Path(blob["path"])
+
+    @staticmethod
+    def _blob_valid(blob: Dict) -> bool:
+        """
+        El blob existe y no cambió desde que se guardó. Importa para hardlinks:
+        si la fuente se reescribe en el mismo inode, el digest ya no corresponde.
+        """
+        try:
+            st = os.stat(blob["path"])
+        except OSError:
+            return False
+        if st.st_size != int(blob.get("size", -1)):
+            return False
+        return "mtime_ns" not in blob or st.st_mtime_ns == blob["mtime_ns"]
+
+    def _drop(self, digest: str) -> None:
+        """Quita el blob (su link en blobs/) y todas las claves que apuntan a él."""
+        blob = self._index["blobs"].pop(digest, None)
+        if blob is not None:
+            Path(blob["path"]).unlink(missing_ok=True)
+        for k in [k for k, d in self._index["keys"].items() if d == digest]:
+            self._index["keys"].pop(k, None)
+
+    def _lease(self, path: Path) -> Path:
+        now = time.time()
+        self._leases = {p: t for p, t in self._leases.items() if now - t < LEASE_S}
+        self._leases[str(path)] = now
+        return path
+
+    @staticmethod
+    def _counted(blob: Dict) -> bool:
+        """
+        Ocupa disco propio si es el único link a sus bytes (st_nlink == 1).
+        Se decide en cada llamada: un hardlink cuya fuente se borró pasa a contar.
+        """
+        try:
+            return os.stat(blob["path"]).st_nlink == 1
+        except OSError:
+            return False
+
+    def _store(self, key: str, src: Path, name: str, move: bool, version: Optional[int]) -> Path:
+        """
+        Registra src en el cache. Si el digest ya existe, reutiliza el blob.
+        move=True: src es temporal (descarga) y se mueve; si no, se enlaza.
+        """
+        digest = _sha256_file(src)
+        blob = self._index["blobs"].get(digest)
+        dst = self._blob_path(digest, name)
+
+        if blob is not None and not self._blob_valid(blob):
+            self._drop(digest)
+            blob = None
+
+        if blob is None:
+            if move:
+                os.replace(src, dst)
+                method = "download"
+            else:
+                method = _link_or_copy(src, dst)
+            st = dst.stat()
+            blob = {
+                "path": str(dst),
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "method": method,
+                "name": name,
+                "version": version,
+            }
+            self._index["blobs"][digest] = blob
+        elif move:
+            src.unlink(missing_ok=True)
+
+        blob["last_used"] = time.time()
+        if version is not None:
+            blob["version"] = version
+        self._index["keys"][key] = digest
+        return Path(blob["path"])
+
+    # -------------------------
+    # API
+    # -------------------------
+    def get_run_artifact(self, client, run_id: str, artifact_rel: str, version: Optional[int] = None) -> Path:
+        """
+        Devuelve el checkpoint de runs:/<run_id>/<artifact_rel>, descargándolo solo si no está en cache.
+        """
+        key = f"run:{run_id}/{artifact_rel}"
+        with self._lock:
+            hit = self._lookup(key)
+            if hit is not None:
+                self._write_index()
+                return self._lease(hit)
+
+        # descargar fuera del lock (puede tardar), a un tmp en el mismo filesystem
+        tmp_dir = Path(tempfile.mkdtemp(prefix="dl_", dir=self.cache_dir))
+        try:
+            downloaded = Path(client.download_artifacts(run_id, artifact_rel, tmp_dir.as_posix()))
+            if downloaded.is_dir():
+                downloaded = downloaded / Path(artifact_rel).name
+
+            with self._lock:
+                path = self._lease(
+                    self._store(key, downloaded, Path(artifact_rel).name, move=True, version=version)
+                )
+                self.evict()
+                self._write_index()
+                return path
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_file(self, src_path: Path, version: Optional[int] = None) -> Path:
+        """
+        Devuelve el checkpoint apuntado por file:..., enlazado en el cache (sin copiar bytes si se puede).
+        La clave incluye tamaño y mtime para no re-hashear un archivo que no cambió.
+        """
+        src_path = src_path.resolve()
+        st = src_path.stat()
+        key = f"file:{src_path.as_posix()}:{st.st_size}:{st.st_mtime_ns}"
+        with self._lock:
+            hit = self._lookup(key)
+            if hit is None:
+                hit = self._lease(self._store(key, src_path, src_path.name, move=False, version=version))
+                self.evict()
+            else:
+                self._lease(hit)
+            self._write_index()
+            return hit
+
+    def pin(self, path: Optional[Path]) -> None:
+        """Marca el checkpoint activo: se toca su last_used y nunca se desaloja."""
+        with self._lock:
+            self._pinned = str(path) if path is not None else None
+            for blob in self._index["blobs"].values():
+                if blob["path"] == self._pinned:
+                    blob["last_used"] = time.time()
+            self._write_index()
+
+    def evict(self) -> None:
+        """
+        LRU: borra los blobs menos usados hasta quedar bajo max_bytes, contando solo
+        los que son dueños de sus bytes. Los hardlinks vivos (no liberan disco) se
+        recortan por cantidad (MAX_LINKED_ENTRIES) para que el índice no crezca sin fin.
+        Nunca borra el activo (pin), el más reciente, ni los entregados hace < LEASE_S.
+        """
+        with self._lock:
+            blobs = self._index["blobs"]
+            # blobs borrados o cuyo inode cambió (hardlink a una fuente reescrita)
+            for digest in [d for d, b in blobs.items() if not self._blob_valid(b)]:
+                self._drop(digest)
+
+            owned = {d: self._counted(b) for d, b in blobs.items()}
+            total = sum(int(b.get("size", 0)) for d, b in blobs.items() if owned[d])
+            linked = sum(1 for d in blobs if not owned[d])
+            if total <= self.max_bytes and linked <= MAX_LINKED_ENTRIES:
+                return
+
+            order = sorted(blobs.items(), key=lambda kv: kv[1].get("last_used", 0))
+            now = time.time()
+            leased = {p for p, t in self._leases.items() if now - t < LEASE_S}
+            protected = set()
+            if order:
+                protected.add(order[-1][0])
+            protected.update(
+                d for d, b in blobs.items() if b["path"] == self._pinned or b["path"] in leased
+            )
+
+            for digest, blob in order:
+                if total <= self.max_bytes and linked <= MAX_LINKED_ENTRIES:
+                    break
+                if digest in protected:
+                    continue
+                if owned[digest] and total > self.max_bytes:
+                    total -= int(blob.get("size", 0))
+                    self._drop(digest)
+                elif not owned[digest] and linked > MAX_LINKED_ENTRIES:
+                    linked -= 1
+                    self._drop(digest)
+
+    def record_prefetch(self, stage: str, version: Optional[int], error: Optional[str] = None) -> None:
+        """Guarda el resultado del último prefetch en segundo plano (se ve en /health)."""
+        with self._lock:
+            self.last_prefetch = {
+                "stage": stage,
+                "version": version,
+                "ok": error is None,
+                "error": error,
+                "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+
+    def info(self) -> Dict:
+        with self._lock:
+            blobs = self._index["blobs"]
+            counted = [b for b in blobs.values() if self._counted(b)]  # dueños de sus bytes
+            return {
+                "dir": str(self.cache_dir),
+                "entries": len(blobs),
+                "linked_entries": len(blobs) - len(counted),
+                "size_mb": round(sum(int(b.get("size", 0)) for b in counted) / (1024 * 1024), 1),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 1),
+                "last_prefetch": self.last_prefetch,
+            }
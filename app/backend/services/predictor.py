@@ -2,11 +2,15 @@
 predictor.py
 - Carga checkpoint local best_*.pt por defecto.
 - Puede recargar desde MLflow Model Registry descargando el artifact .pt.
+- Los .pt del registry pasan por CheckpointCache (sin descargas ni copias repetidas).
 """
 
 import io
+import os
+import threading
+import time
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from urllib.parse import urlparse, unquote
 
 import torch
@@ -17,29 +21,55 @@ from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 
 from mlflow.tracking import MlflowClient
 
+from services.admission import check_deadline
+from services.ckpt_cache import CheckpointCache
+
 TARGET_CLASSES = ["person", "car", "airplane"]
 
+# defaults de torchvision FasterRCNN (roi_heads)
+DEFAULT_NMS_IOU = 0.5
+DEFAULT_MAX_DETECTIONS = 100
+
+# warm-up: resoluciones (HxW) representativas de las imágenes que llegan
+WARMUP_SIZES = [
+    tuple(int(v) for v in hw.split("x"))
+    for hw in os.environ.get("WARMUP_SIZES", "480x640,640x480,720x1280").split(",")
+    if hw.strip()
+]
+WARMUP_RUNS = int(os.environ.get("WARMUP_RUNS", "2"))
+
 print("LOADED PREDICTOR FROM:", __file__)
 
 class Predictor:
-    def __init__(self, project_root: Path):
+    def __init__(self, project_root: Path, load_on_init: bool = True):
         self.project_root = project_root.resolve()
         self.models_dir = (self.project_root / "models" / "local_checkpoints").resolve()
         self.models_dir.mkdir(parents=True, exist_ok=True)
+        self.ckpt_cache = CheckpointCache(self.models_dir / "cache")
 
         self.device = torch.device("cpu")
         self.model = None
+        self._infer_lock = threading.Lock()
+        self._load_lock = threading.Lock()  # una carga (+ warm-up) a la vez
         self.internal_to_name = None
         self.ckpt_path: Optional[Path] = None
 
+        # warm-up: ready=False hasta que el primer modelo termina de calentar
+        self.ready = False
+        self.warming_up = False
+        self.warmup_ms: Optional[float] = None
+        self.warmup_image_ms: Optional[float] = None  # ms/imagen en el último pase (ya caliente)
+
         # info activo
         self.active_source = "local"  # local | mlflow-registry
         self.active_version: Optional[int] = None
         self.active_source = "local"
         self.active_version = None
         self.ckpt_path = None
+        self._active = ("local", None, None)  # (source, version, ckpt_path) publicado junto
 
-        self._load_latest_local()
+        if load_on_init:
+            self._load_latest_local()
 
     # -------------------------
     # Build model
@@ -63,7 +93,11 @@ class Predictor:
             raise FileNotFoundError("No hay best_*.pt en models/local_checkpoints.")
         return cands[0]
 
-    def _load_from_ckpt_path(self, ckpt_path: Path):
+    def _load_from_ckpt_path(self, ckpt_path: Path, source: str = "local", version: Optional[int] = None):
+        with self._load_lock:
+            self._load_from_ckpt_path_locked(ckpt_path, source, version)
+
+    def _load_from_ckpt_path_locked(self, ckpt_path: Path, source: str, version: Optional[int]):
         ckpt = torch.load(ckpt_path, map_location="cpu")
 
         target_classes = ckpt.get("target_classes", TARGET_CLASSES)
@@ -81,15 +115,51 @@ class Predictor:
         model.to(self.device)
         model.eval()
 
-        self.model = model
-        self.internal_to_name = internal_to_name
-        self.ckpt_path = ckpt_path
+        # calentar antes de activarlo (el modelo anterior sigue sirviendo mientras tanto)
+        self.warming_up = True
+        try:
+            warmup_ms, warmup_image_ms = self._warmup(model)
+        finally:
+            self.warming_up = False
+
+        # publicar modelo + label map + checkpoint + origen juntos: predict_bytes los lee
+        # bajo el mismo lock; get_active_info lee la tupla _active de una sola vez
+        with self._infer_lock:
+            self.model = model
+            self.internal_to_name = internal_to_name
+            self.ckpt_path = ckpt_path
+            self.active_source = source
+            self.active_version = version
+            self._active = (source, version, ckpt_path)
+        self.warmup_ms = warmup_ms
+        self.warmup_image_ms = warmup_image_ms
+        self.ready = True
+
+    @torch.no_grad()
+    def _warmup(self, model) -> Tuple[float, Optional[float]]:
+        """
+        Pasa imágenes sintéticas por el modelo para que el allocator y oneDNN
+        creen sus buffers / primitivas antes del primer request real.
+        Devuelve (tiempo total en ms, ms promedio del último pase por tamaño).
+        El último pase ya no paga los costos de arranque: sirve como estimación en régimen.
+        """
+        t0 = time.perf_counter()
+        last_pass_ms = []
+        for h, w in WARMUP_SIZES:
+            x = torch.rand(3, h, w, device=self.device)
+            for _ in range(WARMUP_RUNS):
+                t1 = time.perf_counter()
+                model([x])
+                run_ms = (time.perf_counter() - t1) * 1000.0
+            if WARMUP_RUNS > 0:
+                last_pass_ms.append(run_ms)
+        total_ms = (time.perf_counter() - t0) * 1000.0
+        image_ms = sum(last_pass_ms) / len(last_pass_ms) if last_pass_ms else None
+        return total_ms, image_ms
 
     def _load_latest_local(self):
         ckpt_path = self._find_latest_best()
-        self._load_from_ckpt_path(ckpt_path)
-        self.active_source = "local"
-        self.active_version = None
+        self._load_from_ckpt_path(ckpt_path, source="local", version=None)
 
     # -------------------------
     # MLflow registry load (download .pt artifact)
@@ -107,6 +177,19 @@ class Predictor:
         if self.active_source == "mlflow-registry" and self.active_version == version:
             return True
 
+        ckpt_path = self._resolve_version_ckpt(client, mv)
+        self._load_from_ckpt_path(ckpt_path, source="mlflow-registry", version=version)
+        self.ckpt_cache.pin(ckpt_path)
+
+        self._prefetch_stage(model_name, "Staging")
+        return True
+
+    def _resolve_version_ckpt(self, client: MlflowClient, mv) -> Path:
+        """
+        Devuelve la ruta local (en cache) del .pt de una ModelVersion.
+        Solo descarga / enlaza si no está ya en models/local_checkpoints/cache.
+        """
+        version = int(mv.version)
         src = (mv.source or "").strip()
 
         # --------------------------
@@ -116,23 +199,7 @@ class Predictor:
             # runs:/RUNID/checkpoints/file.pt
             rest = src[len("runs:/") :]
             run_id, artifact_rel = rest.split("/", 1)
-
-            dst_name = f"mlflow_v{version}_{Path(artifact_rel).name}"
-            dst_dir = self.models_dir.resolve()
-
-            downloaded = client.download_artifacts(run_id, artifact_rel, dst_dir.as_posix())
-            downloaded_path = Path(downloaded)
-
-            # download_artifacts puede devolver el directorio; ajustamos al archivo
-            if downloaded_path.is_dir():
-                downloaded_path = downloaded_path / Path(artifact_rel).name
-
-            self._load_from_ckpt_path(downloaded_path)
-
-            self.active_source = "mlflow-registry"
-            self.active_version = version
-            self.ckpt_path = downloaded_path
-            return True
+            return self.ckpt_cache.get_run_artifact(client, run_id, artifact_rel, version=version)
 
         # --------------------------
         # Caso B: file:/... o file:c:/...
@@ -153,23 +220,30 @@ class Predictor:
             if not ckpt_path.exists():
                 raise FileNotFoundError(f"No existe el checkpoint apuntado por MLflow: {ckpt_path}")
 
-            # Copiar a local_checkpoints para tenerlo consistente
-            dst_name = f"mlflow_v{version}_{ckpt_path.name}"
-            dst_path = (self.models_dir / dst_name).resolve()
-
-            if dst_path != ckpt_path:
-                dst_path.write_bytes(ckpt_path.read_bytes())
-                ckpt_path = dst_path
-
-            self._load_from_ckpt_path(ckpt_path)
-
-            self.active_source = "mlflow-registry"
-            self.active_version = version
-            self.ckpt_path = ckpt_path
-            return True
+            # Enlazar (hardlink/reflink) en el cache para tenerlo consistente sin copiar bytes
+            return self.ckpt_cache.get_file(ckpt_path, version=version)
 
         raise RuntimeError(f"ModelVersion.source inesperado: {mv.source}")
 
+    def _prefetch_stage(self, model_name: str, stage: str) -> None:
+        """
+        Deja en cache (en segundo plano) la última versión de `stage`,
+        para que la próxima promoción no tenga que descargar nada.
+        """
+        def _run():
+            version = None
+            try:
+                client = MlflowClient()
+                latest = client.get_latest_versions(model_name, stages=[stage])
+                if latest and int(latest[0].version) != self.active_version:
+                    version = int(latest[0].version)
+                    self._resolve_version_ckpt(client, latest[0])
+                self.ckpt_cache.record_prefetch(stage, version)
+            except Exception as e:
+                self.ckpt_cache.record_prefetch(stage, version, error=str(e))
+
+        threading.Thread(target=_run, daemon=True).start()
+
     def reload(self):
         """Recarga desde el último best_*.pt local (fallback)."""
         self._load_latest_local()
@@ -181,40 +255,94 @@ class Predictor:
             "checkpoint": str(self.ckpt_path) if self.ckpt_path else None,
         }
     def get_active_info(self) -> Dict:
+        source, version, ckpt_path = self._active
         return {
-            "source": getattr(self, "active_source", "local"),
-            "mlflow_version": getattr(self, "active_version", None),
-            "checkpoint": str(self.ckpt_path) if getattr(self, "ckpt_path", None) else None,
+            "source": source,
+            "mlflow_version": version,
+            "checkpoint": str(ckpt_path) if ckpt_path else None,
+            "ready": self.ready,
+            "warming_up": self.warming_up,
+            "warmup_ms": self.warmup_ms,
+            "cache": self.ckpt_cache.info(),
         }
     # -------------------------
     # Predict
     # -------------------------
+    def _apply_postprocess(
+        self,
+        model,
+        score_threshold: float,
+        max_detections: Optional[int],
+        nms_iou: Optional[float],
+    ) -> None:
+        """
+        Empuja umbral / NMS / max detecciones dentro de roi_heads,
+        así el modelo descarta candidatos antes de devolverlos.
+        """
+        if not 0.0 <= float(score_threshold) <= 1.0:
+            raise ValueError(f"score_threshold fuera de [0, 1]: {score_threshold}")
+        if nms_iou is not None and not 0.0 <= float(nms_iou) <= 1.0:
+            raise ValueError(f"nms_iou fuera de [0, 1]: {nms_iou}")
+        if max_detections is not None and int(max_detections) < 1:
+            raise ValueError(f"max_detections debe ser >= 1: {max_detections}")
+
+        rh = model.roi_heads
+        rh.score_thresh = float(score_threshold)
+        rh.nms_thresh = float(nms_iou) if nms_iou is not None else DEFAULT_NMS_IOU
+        rh.detections_per_img = int(max_detections) if max_detections is not None else DEFAULT_MAX_DETECTIONS
+
     @torch.no_grad()
-    def predict_bytes(self, img_bytes: bytes, score_threshold: float = 0.5) -> Dict:
+    def predict_bytes(
+        self,
+        img_bytes: bytes,
+        score_threshold: float = 0.5,
+        max_detections: Optional[int] = None,
+        nms_iou: Optional[float] = None,
+        deadline: Optional[float] = None,
+    ) -> Dict:
+        """
+        deadline: instante absoluto (time.perf_counter) tras el cual no vale la pena seguir;
+        se revisa antes del decode y antes del forward (lanza DeadlineExceeded).
+        """
         if self.model is None:
             raise RuntimeError("El modelo no está cargado. Llama a reload() o reload_from_registry().")
 
+        check_deadline(deadline, "decode")
+        t0 = time.perf_counter()
         img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
         x = F.to_tensor(img).to(self.device)
-
-        out = self.model([x])[0]
-        boxes = out["boxes"].cpu().tolist()
-        scores = out["scores"].cpu().tolist()
-        labels = out["labels"].cpu().tolist()
-
-        dets = []
-        for b, s, l in zip(boxes, scores, labels):
-            if float(s) < float(score_threshold):
-                continue
-            name = self.internal_to_name.get(int(l), f"class_{l}")
-            dets.append({"xyxy": b, "score": float(s), "label": name})
-
-        dets = sorted(dets, key=lambda d: d["score"], reverse=True)[:3]
+        decode_ms = (time.perf_counter() - t0) * 1000.0
+
+        # roi_heads es estado compartido: configurar + forward bajo el mismo lock
+        with self._infer_lock:
+            # la espera por el lock es cola: revisar el deadline recién aquí
+            check_deadline(deadline, "forward")
+            t1 = time.perf_counter()
+            model = self.model
+            internal_to_name = self.internal_to_name
+            ckpt_path = self.ckpt_path
+            self._apply_postprocess(model, score_threshold, max_detections, nms_iou)
+            out = model([x])[0]
+            forward_ms = (time.perf_counter() - t1) * 1000.0
+
+        # roi_heads ya aplicó score > score_threshold, NMS por clase y el corte a
+        # detections_per_img; la salida viene ordenada por score descendente.
+        boxes = out["boxes"]
+        scores = out["scores"]
+        labels = out["labels"]
+
+        names = [internal_to_name.get(l, f"class_{l}") for l in labels.tolist()]
+        dets = [
+            {"xyxy": b, "score": s, "label": n}
+            for b, s, n in zip(boxes.tolist(), scores.tolist(), names)
+        ]
 
         return {
             "ok": True,
-            "checkpoint": self.ckpt_path.name if self.ckpt_path else None,
+            "checkpoint": ckpt_path.name if ckpt_path else None,
             "found": len(dets) > 0,
             "message": "no se ha encontrado" if not dets else "ok",
             "detections": dets,
+            # tiempo de servicio (decode + forward), sin contar la espera en cola
+            "inference_ms": decode_ms + forward_ms,
         }